@@ -2,7 +2,7 @@
 import os
 import io
 import csv
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from sklearn.tree import DecisionTreeClassifier, export_graphviz
@@ -10,8 +10,24 @@ from flask_moment import Moment
 import pandas as pd
 import graphviz 
 import base64
+import time
+import atexit
+import threading
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from sqlalchemy import event, func, insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
 
 # --- Konfigurasi Aplikasi ---
+def env_bool(name, default=False):
+    """Membaca variabel lingkungan boolean ('1', 'true', 'yes', 'on')."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
 class Config:
     # Konfigurasi database untuk PostgreSQL di Railway
     # Railway akan secara otomatis menyediakan variabel lingkungan DATABASE_URL
@@ -24,10 +40,45 @@ class Config:
     else:
         print(f"Menggunakan PostgreSQL dari DATABASE_URL: {SQLALCHEMY_DATABASE_URI}")
 
+    # Opsi pool koneksi untuk engine SQLAlchemy. Setiap worker gunicorn memiliki pool sendiri,
+    # jadi total koneksi maksimum = jumlah worker * (DB_POOL_SIZE + DB_MAX_OVERFLOW).
+    # DB_PGBOUNCER=1 menonaktifkan pool di sisi aplikasi (NullPool) karena pooling sudah
+    # dilakukan oleh PgBouncer (mode transaction/statement).
+    DB_PGBOUNCER = env_bool('DB_PGBOUNCER')
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_pre_ping': env_bool('DB_POOL_PRE_PING', True), # Buang koneksi mati sebelum dipakai
+        # Cache hasil kompilasi SQL di sisi SQLAlchemy (default 500 = default SQLAlchemy). Ini bukan
+        # prepared statement di server: psycopg2 tidak memakai prepared statement sisi server.
+        'query_cache_size': int(os.environ.get('DB_QUERY_CACHE_SIZE', 500)),
+    }
+    if SQLALCHEMY_DATABASE_URI.startswith('postgres'):
+        if DB_PGBOUNCER:
+            SQLALCHEMY_ENGINE_OPTIONS['poolclass'] = NullPool
+        else:
+            SQLALCHEMY_ENGINE_OPTIONS.update({
+                'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+                'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+                'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+                'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)), # Detik, hindari koneksi yang diputus server
+                'pool_use_lifo': True, # Pakai ulang koneksi terbaru agar koneksi idle bisa ditutup
+            })
+
+    # Kirim jumlah dan waktu query per request di header respons. Default mati karena
+    # informasi ini tidak boleh terlihat oleh pengunjung publik.
+    DB_QUERY_STATS_HEADERS = env_bool('DB_QUERY_STATS_HEADERS')
+
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = os.environ.get('SECRET_KEY', 'kunci_rahasia_yang_sangat_kuat_dan_unik') # Ganti dengan kunci rahasia yang kuat
     UPLOAD_FOLDER = 'uploads' # Folder untuk menyimpan file CSV sementara
 
+    # Log prediksi publik: ditampung di memori lalu disimpan ke database secara batch
+    PREDICTION_LOG_CAPACITY = int(os.environ.get('PREDICTION_LOG_CAPACITY', 10000)) # Entri tertua dibuang jika penuh
+    PREDICTION_LOG_BATCH_SIZE = int(os.environ.get('PREDICTION_LOG_BATCH_SIZE', 100))
+    PREDICTION_LOG_FLUSH_INTERVAL = float(os.environ.get('PREDICTION_LOG_FLUSH_INTERVAL', 5)) # Detik
+    PREDICTION_LOG_RETENTION_DAYS = int(os.environ.get('PREDICTION_LOG_RETENTION_DAYS', 90)) # Log lebih lama dihapus (0 = simpan selamanya)
+    DRIFT_THRESHOLD = float(os.environ.get('DRIFT_THRESHOLD', 0.2)) # Batas jarak distribusi untuk menandai drift
+    DRIFT_MIN_SAMPLES = int(os.environ.get('DRIFT_MIN_SAMPLES', 30)) # Minimal input prediksi sebelum drift dinilai
+
 app = Flask(__name__)
 moment = Moment(app) 
 app.config.from_object(Config)
@@ -74,6 +125,32 @@ class Dataset(db.Model):
     kondisi_struktur_bangunan = db.Column(db.String(50), nullable=False)
     relokasi = db.Column(db.String(10), nullable=False) # Kolom target
 
+class LogPrediksi(db.Model):
+    __tablename__ = 'tb_log_prediksi'
+    id = db.Column(db.Integer, primary_key=True)
+    waktu = db.Column(db.DateTime, nullable=False, index=True)
+    jenis_bencana = db.Column(db.String(50), nullable=False)
+    kecamatan = db.Column(db.String(50), nullable=False)
+    desa = db.Column(db.String(50), nullable=False)
+    jumlah_anggota_keluarga = db.Column(db.String(10), nullable=False)
+    status_kepemilikan_rumah = db.Column(db.String(50), nullable=False)
+    kondisi_atap = db.Column(db.String(50), nullable=False)
+    kondisi_kolom_balok = db.Column(db.String(50), nullable=False)
+    kondisi_plesteran = db.Column(db.String(50), nullable=False)
+    kondisi_lantai = db.Column(db.String(50), nullable=False)
+    kondisi_pintu_jendela = db.Column(db.String(50), nullable=False)
+    kondisi_instalasi_listrik = db.Column(db.String(50), nullable=False)
+    kondisi_struktur_bangunan = db.Column(db.String(50), nullable=False)
+    relokasi = db.Column(db.String(10), nullable=False) # Hasil prediksi model
+
+# Kolom fitur yang dipakai model C4.5 (semua kolom kecuali 'relokasi' dan 'nama_kk' karena nama_kk unik)
+FEATURES = [
+    'jenis_bencana', 'kecamatan', 'desa', 'jumlah_anggota_keluarga',
+    'status_kepemilikan_rumah', 'kondisi_atap', 'kondisi_kolom_balok',
+    'kondisi_plesteran', 'kondisi_lantai', 'kondisi_pintu_jendela',
+    'kondisi_instalasi_listrik', 'kondisi_struktur_bangunan'
+]
+
 # --- Inisialisasi Database dan Data Awal ---
 with app.app_context():
     db.create_all()
@@ -138,10 +215,41 @@ with app.app_context():
         print("Dataset default baru telah ditambahkan.")
 
 
+# --- Statistik Query per Request ---
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        context._query_start_time = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and hasattr(context, '_query_start_time'):
+        g.db_query_count = g.get('db_query_count', 0) + 1
+        g.db_query_time = g.get('db_query_time', 0.0) + (time.perf_counter() - context._query_start_time)
+
+@app.before_request
+def start_request_timer():
+    g.request_start_time = time.perf_counter()
+
+@app.after_request
+def add_query_stats_headers(response):
+    """Menambahkan jumlah query dan waktu (ms) ke header respons jika DB_QUERY_STATS_HEADERS aktif."""
+    if not app.config['DB_QUERY_STATS_HEADERS']:
+        return response
+    query_count = g.get('db_query_count', 0)
+    query_time_ms = g.get('db_query_time', 0.0) * 1000
+    response.headers['X-DB-Query-Count'] = str(query_count)
+    response.headers['X-DB-Query-Time'] = f"{query_time_ms:.2f}"
+    timings = [f"db;desc=\"{query_count} query\";dur={query_time_ms:.2f}"]
+    if 'request_start_time' in g:
+        timings.append(f"app;dur={(time.perf_counter() - g.request_start_time) * 1000:.2f}")
+    response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+
 # --- Fungsi Pembantu ---
 def login_required(f):
     """Decorator untuk memastikan pengguna sudah login."""
-    from functools import wraps
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'logged_in' not in session:
@@ -150,6 +258,18 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def read_only_session(f):
+    """Decorator untuk rute yang hanya membaca data: session memakai koneksi autocommit
+    (tanpa BEGIN/ROLLBACK per request)."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # Sengaja tanpa postgresql_readonly: dengan autocommit, psycopg2 mengirim SET
+        # default_transaction_read_only saat checkout dan SET lagi saat reset ke pool,
+        # sehingga round trip yang dihemat autocommit habis lagi.
+        db.session.connection(execution_options={'isolation_level': 'AUTOCOMMIT'})
+        return f(*args, **kwargs)
+    return decorated_function
+
 def get_c45_model():
     """Mengambil data dari database, melatih model C4.5, dan mengembalikan model serta fitur yang di-encode."""
     data = Dataset.query.all()
@@ -161,13 +281,7 @@ def get_c45_model():
     df = df.drop(columns=['id'], errors='ignore') # Hapus kolom ID
 
     # Identifikasi fitur (X) dan target (y)
-    # Asumsi kolom fitur adalah semua kolom kecuali 'relokasi' dan 'nama_kk' (karena nama_kk unik)
-    features = [
-        'jenis_bencana', 'kecamatan', 'desa', 'jumlah_anggota_keluarga',
-        'status_kepemilikan_rumah', 'kondisi_atap', 'kondisi_kolom_balok',
-        'kondisi_plesteran', 'kondisi_lantai', 'kondisi_pintu_jendela',
-        'kondisi_instalasi_listrik', 'kondisi_struktur_bangunan'
-    ]
+    features = FEATURES
     target = 'relokasi'
 
     if not all(col in df.columns for col in features + [target]):
@@ -184,6 +298,171 @@ def get_c45_model():
     model.fit(X, y)
     return model, X.columns.tolist(), None # Mengembalikan model, nama kolom fitur, dan pesan error (None jika sukses)
 
+def compute_drift_report(since=None):
+    """Membandingkan frekuensi nilai setiap atribut antara input prediksi (tb_log_prediksi)
+    dan data latih (tb_dataset). Jarak dihitung sebagai total variation distance (0-1)."""
+    threshold = app.config['DRIFT_THRESHOLD']
+    min_samples = app.config['DRIFT_MIN_SAMPLES']
+    report = []
+    live_total = 0
+    for feature in FEATURES:
+        train_col = getattr(Dataset, feature)
+        live_col = getattr(LogPrediksi, feature)
+        train_counts = dict(db.session.query(train_col, func.count()).group_by(train_col).all())
+        live_query = db.session.query(live_col, func.count())
+        if since is not None:
+            live_query = live_query.filter(LogPrediksi.waktu >= since)
+        live_counts = dict(live_query.group_by(live_col).all())
+
+        train_total = sum(train_counts.values())
+        live_total = sum(live_counts.values())
+        values = []
+        distance = 0.0
+        for value in sorted(set(train_counts) | set(live_counts)):
+            train_pct = train_counts.get(value, 0) / train_total if train_total else 0.0
+            live_pct = live_counts.get(value, 0) / live_total if live_total else 0.0
+            distance += abs(train_pct - live_pct)
+            values.append({'nilai': value, 'latih': train_pct, 'prediksi': live_pct})
+        distance = distance / 2 if train_total and live_total else 0.0
+        # Urutkan dari yang paling sering muncul agar nilai spam satu kali tidak menutupi yang penting
+        nilai_baru = sorted((value for value in live_counts if value not in train_counts),
+                            key=lambda value: live_counts[value], reverse=True)
+        report.append({
+            'atribut': feature,
+            'jarak': distance,
+            'nilai_baru': nilai_baru,
+            # None = data belum cukup untuk menilai drift
+            'drift': (distance >= threshold or bool(nilai_baru)) if live_total >= min_samples else None,
+            'nilai': values,
+        })
+    return report, live_total
+
+
+# --- Log Prediksi ---
+class PredictionLog:
+    """Ring buffer di memori untuk input dan hasil prediksi publik. Penyimpanan ke database
+    dilakukan secara batch oleh thread latar belakang, bukan di jalur request."""
+
+    def __init__(self, app):
+        self.app = app
+        self.buffer = deque(maxlen=app.config['PREDICTION_LOG_CAPACITY'])
+        self.batch_size = app.config['PREDICTION_LOG_BATCH_SIZE']
+        self.flush_interval = app.config['PREDICTION_LOG_FLUSH_INTERVAL']
+        self.retention_days = app.config['PREDICTION_LOG_RETENTION_DAYS']
+        self.prune_interval = 3600 # Detik antar penghapusan log lama
+        self.max_retries = 3 # Batch yang gagal disimpan sebanyak ini akan dibuang
+        self.dropped = 0 # Per proses worker
+        # Panjang maksimum setiap kolom agar input publik yang terlalu panjang tidak menggagalkan insert
+        self.column_lengths = {name: LogPrediksi.__table__.c[name].type.length for name in FEATURES + ['relokasi']}
+        self._failures = 0
+        self._last_prune = 0.0
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+
+    def record(self, input_data, result):
+        """Dipanggil dari request: hanya menambah entri ke buffer (deque.append thread-safe).
+        Hanya kolom FEATURES yang disimpan, dipotong sesuai panjang kolom."""
+        lengths = self.column_lengths
+        row = {name: str(input_data.get(name, ''))[:lengths[name]] for name in FEATURES}
+        row['relokasi'] = str(result)[:lengths['relokasi']]
+        if len(self.buffer) == self.buffer.maxlen:
+            self._add_dropped(1)
+        self.buffer.append((time.time(), row))
+        if self._pid != os.getpid(): # Thread dimulai per proses (setelah fork worker gunicorn)
+            self._start()
+        if len(self.buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def _add_dropped(self, count):
+        with self._lock:
+            self.dropped += count
+
+    def _requeue(self, batch):
+        """Mengembalikan batch ke depan buffer; jika buffer penuh, entri terbaru yang terbuang."""
+        self._add_dropped(max(0, len(self.buffer) + len(batch) - self.buffer.maxlen))
+        self.buffer.extendleft(reversed(batch))
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name='prediction-log-flush', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            # Error apa pun tidak boleh menghentikan thread, karena record() tidak akan memulainya lagi
+            try:
+                self.flush()
+                if time.time() - self._last_prune >= self.prune_interval:
+                    self.prune()
+            except Exception as e:
+                print(f"Thread log prediksi gagal. Error: {e}")
+
+    def flush(self):
+        """Memindahkan entri di buffer ke tb_log_prediksi, maksimal batch_size baris per insert.
+        Batch yang gagal dikembalikan ke depan buffer dan dicoba lagi pada flush berikutnya."""
+        saved = 0
+        batch = []
+        try:
+            with self._flush_lock, self.app.app_context():
+                while True:
+                    while len(batch) < self.batch_size:
+                        try:
+                            batch.append(self.buffer.popleft())
+                        except IndexError:
+                            break
+                    if not batch:
+                        break
+                    rows = [dict(row, waktu=datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None))
+                            for timestamp, row in batch]
+                    try:
+                        db.session.execute(insert(LogPrediksi), rows)
+                        db.session.commit()
+                    except Exception as e:
+                        self._failures += 1
+                        if self._failures >= self.max_retries:
+                            self._failures = 0
+                            self._add_dropped(len(batch))
+                            print(f"Membuang {len(batch)} log prediksi setelah {self.max_retries} kali gagal disimpan. Error: {e}")
+                            batch = []
+                        else:
+                            print(f"Gagal menyimpan {len(batch)} log prediksi, akan dicoba lagi. Error: {e}")
+                        db.session.rollback()
+                        if not batch:
+                            continue
+                        break
+                    self._failures = 0
+                    saved += len(batch)
+                    batch = []
+        finally:
+            # Batch yang belum tersimpan (termasuk jika rollback/teardown error) dikembalikan ke buffer
+            if batch:
+                self._requeue(batch)
+        return saved
+
+    def prune(self):
+        """Menghapus log yang lebih lama dari PREDICTION_LOG_RETENTION_DAYS."""
+        self._last_prune = time.time()
+        if self.retention_days <= 0:
+            return 0
+        cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=self.retention_days)
+        with self.app.app_context():
+            try:
+                deleted = LogPrediksi.query.filter(LogPrediksi.waktu < cutoff).delete(synchronize_session=False)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        return deleted
+
+prediction_log = PredictionLog(app)
+atexit.register(prediction_log.flush) # Simpan sisa buffer saat proses berhenti
+
 
 # --- Rute Aplikasi ---
 
@@ -359,6 +638,7 @@ def delete_attribute_value(id):
 # --- Rute Dataset ---
 @app.route('/dataset')
 @login_required
+@read_only_session
 def dataset():
     all_dataset = Dataset.query.all()
     return render_template('dataset.html', dataset=all_dataset)
@@ -552,6 +832,7 @@ def import_csv():
 # --- Rute C4.5 Tree & Calculation ---
 @app.route('/tree')
 @login_required
+@read_only_session
 def tree():
     model, feature_names, error_msg = get_c45_model()
     tree_image_base64 = None
@@ -576,6 +857,7 @@ def tree():
 
 @app.route('/calculation')
 @login_required
+@read_only_session
 def calculation():
     # Untuk bagian perhitungan, kita akan menampilkan informasi dasar tentang model
     # dan mungkin beberapa statistik dataset. Perhitungan gain/gain ratio detail
@@ -596,9 +878,30 @@ def calculation():
         
     return render_template('calculation.html', model_info=model_info, feature_importances=feature_importances)
 
+@app.route('/drift')
+@login_required
+@read_only_session
+def drift():
+    # Jendela waktu input prediksi yang dibandingkan, dalam hari (0 atau lebih dari 10 tahun = semua data)
+    hari = request.args.get('hari', 30, type=int)
+    if hari and 0 < hari <= 3650:
+        since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=hari)
+    else:
+        since = None
+    report, live_total = compute_drift_report(since)
+    return render_template('drift.html',
+                           report=report,
+                           live_total=live_total,
+                           hari=hari,
+                           threshold=app.config['DRIFT_THRESHOLD'],
+                           min_samples=app.config['DRIFT_MIN_SAMPLES'],
+                           pending=len(prediction_log.buffer),
+                           dropped=prediction_log.dropped)
+
 
 # --- Rute Prediksi ---
 @app.route('/predict', methods=['GET', 'POST'])
+@read_only_session
 def predict(): # TIDAK ADA login_required di sini, karena ini untuk masyarakat
     model, feature_names, error_msg = get_c45_model()
     prediction_result = None
@@ -647,6 +950,7 @@ def predict(): # TIDAK ADA login_required di sini, karena ini untuk masyarakat
                 try:
                     prediction = model.predict(input_encoded)
                     prediction_result = prediction[0]
+                    prediction_log.record(input_data, prediction_result)
                     flash(f'Prediksi Relokasi: {prediction_result}', 'info')
                 except Exception as e:
                     flash(f"Gagal melakukan prediksi. Error: {e}", 'danger')